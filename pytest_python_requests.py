@@ -1,38 +1,124 @@
 import argparse
+import hashlib
 import json
-import os
 import re
-import textwrap
-from contextlib import redirect_stdout
-from functools import partial
-from io import StringIO
+import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
-from types import ModuleType
+from string import Formatter
+from typing import TYPE_CHECKING
 
-import pydash as _
 import pytest
-import requests
-import trafaret as t
-import yaml
 from _pytest.outcomes import Failed
 
-replace_groups = re.compile(
-    r"\{(\s*?(?P<name>[a-z_]+)((\.).+)?\s*?)\}", flags=re.MULTILINE
-).finditer
+# The heavy dependencies are imported on first use, every pytest run loads this
+# plugin even if there is nothing to collect.
+if TYPE_CHECKING:
+    import requests
+
+
+@lru_cache(maxsize=None)
+def get_yaml():
+    """Return the yaml module and its loader, imported together once.
+
+    The libyaml bindings only work with the yaml module that first loaded them,
+    a later ``import yaml`` can get a new module if sys.modules was restored.
+    """
+    import yaml
+
+    # Prefer the libyaml bindings when available, they are much faster to parse.
+    return yaml, getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+replace_groups = re.compile(r"\{(\s*?(?P<name>[a-z_]+)((\.).+)?\s*?)\}").finditer
+
+
+@lru_cache(maxsize=8192)
+def _extract_names(value):
+    return frozenset(match.group("name") for match in replace_groups(value))
 
 
 def transform_string_replace(value, context):
-    if context:
-        names = {match.groupdict()["name"] for match in replace_groups(value) if match}
-        for name in names:
-            if name in context:
-                value = value.format(**{name: context[name]})
+    if not context or "{" not in value:
+        return value
+
+    needed = _extract_names(value) & context.keys()
+
+    if needed:
+        value = value.format_map({name: context[name] for name in needed})
 
     return value
 
 
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+
+
+def _slugify(value: str):
+    return _SLUG_RE.sub("_", value.lower()).strip("_")
+
+
+_formatter = Formatter()
+_identifiers = re.compile(r"[A-Za-z_]\w*").findall
+
+
+@lru_cache(maxsize=8192)
+def compile_format(value: str):
+    """Split a format string in (literal, name) pairs.
+
+    Returns None if the string uses indexes, attributes, conversions or format
+    specs, those are left to str.format_map.
+    """
+    parts = []
+
+    for literal, name, format_spec, conversion in _formatter.parse(value):
+        if name is not None and (format_spec or conversion or not name.isidentifier()):
+            return None
+
+        parts.append((literal, name))
+
+    return tuple(parts)
+
+
+def format_string(value: str, variables: dict):
+    parts = compile_format(value)
+
+    if parts is None:
+        return value.format_map(variables)
+
+    return "".join(
+        literal if name is None else literal + format(variables[name])
+        for literal, name in parts
+    )
+
+
+def format_options(options: dict, variables: dict):
+    """Return a copy of the options with the variables replaced in every string."""
+    result = {}
+    stack = [(options, result)]
+
+    while stack:
+        source, target = stack.pop()
+        items = source.items() if isinstance(source, dict) else enumerate(source)
+
+        for key, value in items:
+            if isinstance(value, str):
+                value = format_string(value, variables)
+            elif isinstance(value, dict):
+                stack.append((value, {}))
+                value = stack[-1][1]
+            elif isinstance(value, list):
+                stack.append((value, [None] * len(value)))
+                value = stack[-1][1]
+
+            target[key] = value
+
+    return result
+
+
 def transform_default_request(value, context):
-    return RequestOptionsCompleteType.transform(
+    return get_schemas().request_options_complete.transform(
         {"url": value, "method": "GET"}, context=context
     )
 
@@ -44,188 +130,530 @@ def transform_default_baseurl(value: str, context):
     return value
 
 
-Optional = partial(t.Key, optional=True)
-String = t.String(allow_blank=True) >> transform_string_replace
-SimpleType = String | t.ToBool | t.Bool | t.Float | t.Int | t.Null
-DataType = t.Mapping(
-    t.String,
-    SimpleType
-    | t.List(SimpleType | t.Mapping(t.String, SimpleType | t.List(SimpleType))),
-)
-ComplexType = SimpleType | t.List(SimpleType | DataType) | DataType
-AssertFuncType = t.String | t.Mapping(t.String, SimpleType | DataType)
-RegisterVariablesType = t.Mapping(t.String, SimpleType)
-RequestOptionsShortType = String >> transform_default_request
-
-RequestOptionsCompleteType = t.Dict(
-    {
-        "url": String >> transform_default_baseurl,
-        t.Key("method", default="GET"): t.Enum(
-            "GET", "POST", "PUT", "OPTIONS", "DELETE", "INFO", "HEAD", "PATCH"
-        ),
-        Optional("params"): t.Mapping(t.String, SimpleType),
-        Optional("data"): t.Mapping(t.String, t.Any),
-        Optional("json"): t.Mapping(t.String, t.Any),
-        Optional("headers"): t.Mapping(String, String),
-    }
+Schemas = namedtuple(
+    "Schemas", ["request_options_complete", "request_tests", "rest_documents"]
 )
 
-RequestOptionsType = RequestOptionsShortType | RequestOptionsCompleteType
 
-IncludeRequestTestType = t.Dict({"include": t.String})
+@lru_cache(maxsize=None)
+def get_schemas() -> Schemas:
+    import trafaret as t
 
-RequestTestType = t.Dict(
-    {
-        Optional("name"): t.String,
-        "request": RequestOptionsType >> (lambda options: [options])
-        | t.List(RequestOptionsType),
-        Optional("assert", default=list): t.List(AssertFuncType),
-        Optional("register", default=dict): RegisterVariablesType,
-    }
-)
+    Optional = partial(t.Key, optional=True)
+    String = t.String(allow_blank=True) >> transform_string_replace
+    SimpleType = String | t.ToBool | t.Bool | t.Float | t.Int | t.Null
+    DataType = t.Mapping(
+        t.String,
+        SimpleType
+        | t.List(SimpleType | t.Mapping(t.String, SimpleType | t.List(SimpleType))),
+    )
+    AssertFuncType = t.String | t.Mapping(t.String, SimpleType | DataType)
+    RegisterVariablesType = t.Mapping(t.String, SimpleType)
+    RequestOptionsShortType = String >> transform_default_request
+
+    RequestOptionsCompleteType = t.Dict(
+        {
+            "url": String >> transform_default_baseurl,
+            t.Key("method", default="GET"): t.Enum(
+                "GET", "POST", "PUT", "OPTIONS", "DELETE", "INFO", "HEAD", "PATCH"
+            ),
+            Optional("params"): t.Mapping(t.String, SimpleType),
+            Optional("data"): t.Mapping(t.String, t.Any),
+            Optional("json"): t.Mapping(t.String, t.Any),
+            Optional("headers"): t.Mapping(String, String),
+        }
+    )
 
-RestDocumentType = t.Dict(
-    {
-        "name": t.String,
-        t.Key("variables", default={}): t.Mapping(t.String, SimpleType),
-        "stages": t.List(RequestTestType | IncludeRequestTestType),
-    },
-    allow_extra="*",
-)
+    RequestOptionsType = RequestOptionsShortType | RequestOptionsCompleteType
+
+    IncludeRequestTestType = t.Dict({"include": t.String})
+
+    RequestTestType = t.Dict(
+        {
+            Optional("name"): t.String,
+            "request": RequestOptionsType >> (lambda options: [options])
+            | t.List(RequestOptionsType),
+            Optional("assert", default=list): t.List(AssertFuncType),
+            Optional("register", default=dict): RegisterVariablesType,
+        }
+    )
+
+    RestDocumentType = t.Dict(
+        {
+            "name": t.String,
+            t.Key("variables", default={}): t.Mapping(t.String, SimpleType),
+            "stages": t.List(RequestTestType | IncludeRequestTestType),
+        },
+        allow_extra="*",
+    )
+
+    RestDocumentsType = t.List(RestDocumentType)
+
+    return Schemas(
+        request_options_complete=RequestOptionsCompleteType,
+        request_tests=t.List(RequestTestType),
+        rest_documents=RestDocumentsType,
+    )
+
+
+@lru_cache(maxsize=4096)
+def _assert_code(defname, expression):
+    src = f"def {defname}():\n    assert {expression}\n"
+    return compile(src, defname, "exec")
+
+
+@lru_cache(maxsize=4096)
+def _compile_eval(expr, filename):
+    return compile(expr, filename, "eval")
+
+
+@lru_cache(maxsize=None)
+def get_pooled_adapter():
+    """Transport adapter shared by every session to reuse connections."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    return HTTPAdapter(
+        pool_connections=50,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.1),
+    )
 
-RestDocumentsType = t.List(RestDocumentType)
 
-assert_def_source = """
+class HTTPXRequest:
+    """Expose an httpx request like a requests PreparedRequest."""
 
-def {defname}():
-    assert {expression}
+    def __init__(self, request):
+        self.method = request.method
+        self.url = str(request.url)
+        self.headers = request.headers
+        self.body = request.read() or None
 
-""".format
 
+class HTTPXResponse:
+    """Expose an httpx response like a requests Response."""
 
-def session_request(session: requests.Session, **options):
+    def __init__(self, response):
+        self._response = response
+        self.request = HTTPXRequest(response.request)
+
+    @property
+    def ok(self):
+        return self._response.is_success
+
+    @property
+    def url(self):
+        return str(self._response.url)
+
+    @property
+    def reason(self):
+        return self._response.reason_phrase
+
+    def iter_content(self, chunk_size=1):
+        return self._response.iter_bytes(chunk_size)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+@lru_cache(maxsize=None)
+def get_httpx_transport():
+    """HTTP/2 transport shared by every httpx session to reuse connections."""
+    import httpx
+
+    return httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+
+
+class HTTPXSession:
+    """Thin adapter to use an HTTP/2 httpx client in place of a requests session.
+
+    Every session keeps its own cookies, the connections live in the transport.
+    """
+
+    def __init__(self, transport):
+        import httpx
+
+        self.client = httpx.Client(transport=transport)
+
+    def request(self, method, url, allow_redirects=True, stream=False, **options):
+        # httpx responses are always read, stream is ignored
+        import httpx
+        import requests
+
+        try:
+            response = self.client.request(
+                method, url, follow_redirects=allow_redirects, **options
+            )
+        except httpx.HTTPError as err:
+            raise requests.RequestException(str(err)) from err
+
+        return HTTPXResponse(response)
+
+
+def get_session(http2: bool = False) -> "requests.Session":
+    import requests
+
+    if http2:
+        try:
+            return HTTPXSession(get_httpx_transport())
+        except ImportError as err:
+            warnings.warn(
+                "HTTP/2 requires httpx[http2], using requests instead: %s" % err
+            )
+
+    session = requests.Session()
+    adapter = get_pooled_adapter()
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+_ALLOW_REDIRECTS_DEFAULT = {"GET": True, "OPTIONS": True, "HEAD": False}
+
+
+def session_request(session: "requests.Session", **options):
     __tracebackhide__ = True
 
+    import requests
+
     # Use the same defaults that session.get if is the case.
-    if options["method"] == {"GET", "OPTIONS"}:
-        options.setdefault("allow_redirects", True)
-    elif options["method"] in {"HEAD"}:
-        options.setdefault("allow_redirects", False)
+    options.setdefault(
+        "allow_redirects", _ALLOW_REDIRECTS_DEFAULT.get(options["method"], True)
+    )
+
+    # The body is only read if an expression or a failure report needs it
+    options.setdefault("stream", True)
 
     try:
-        response = session.request(**options, cookies=session.cookies)
+        response = session.request(**options)
     except requests.RequestException as err:
         raise FailRequestError(spec=options, message=str(err)) from err
 
     return response
 
 
+MAX_FORMATTED_CONTENT = 64 * 1024
+
+_search_charset = re.compile(r"charset=[\"']?([\w.:-]+)", re.I).search
+
+
+def get_stream_errors():
+    """Errors raised by requests when reading a streamed body fails."""
+    from requests import exceptions
+
+    return (
+        exceptions.ChunkedEncodingError,
+        exceptions.ContentDecodingError,
+        exceptions.ConnectionError,
+        exceptions.StreamConsumedError,
+    )
+
+
+def release_response(response):
+    """Discard the unread body of a response to give its connection to the pool."""
+    try:
+        for _ in response.iter_content(chunk_size=65536):
+            pass
+    finally:
+        response.close()
+
+
 def format_response(response):
     def format_headers(headers):
-        return "\n".join("{}: {}".format(k, v) for k, v in headers.items())
+        return ["{}: {}".format(k, v) for k, v in headers.items()]
 
-    stdout = StringIO()
     request = response.request
 
-    with redirect_stdout(stdout):
-        print("HTTP/1.1 {request.method} {request.url}".format(request=request))
-        print(format_headers(request.headers))
+    parts = ["HTTP/1.1 {request.method} {request.url}".format(request=request)]
+    parts.extend(format_headers(request.headers))
 
-        if response.request.body:
-            print("")
-            print(response.request.body)
+    if request.body:
+        parts.extend(["", str(request.body)])
 
-        print("")
+    # Response
+    parts.extend(["", "HTTP/1.1 {response.status_code}".format(response=response)])
+    parts.extend(format_headers(response.headers))
 
-        # Response
-        print("HTTP/1.1 {response.status_code}".format(response=response))
-        print(format_headers(response.headers))
+    import requests
 
-        print("")
-        print(response.content.decode())
+    # Read the body in chunks, big responses are truncated
+    content = bytearray()
+    truncated = False
 
-    return textwrap.indent(stdout.getvalue(), prefix="  ")
+    try:
+        for chunk in response.iter_content(chunk_size=65536):
+            content.extend(chunk)
 
+            if len(content) > MAX_FORMATTED_CONTENT:
+                truncated = True
+                break
+    except requests.RequestException as err:
+        parts.extend(["", "<body unavailable: {}>".format(err)])
+        return indent_lines(parts)
 
-def get_request_items(fspath, parent=None, context: dict = None):
-    context = {} if context is None else context
+    # Only trust an explicit charset, requests falls back to ISO-8859-1 for text/*
+    charset = _search_charset(response.headers.get("content-type", ""))
+
+    try:
+        content = content[:MAX_FORMATTED_CONTENT].decode(
+            charset.group(1) if charset else "utf-8", "replace"
+        )
+    except LookupError:
+        content = content[:MAX_FORMATTED_CONTENT].decode("utf-8", "replace")
+
+    if truncated:
+        content += "\n... (truncated)"
+
+    parts.extend(["", content])
+
+    return indent_lines(parts)
 
-    if parent is not None:
-        context["baseurl"] = parent.config.getoption("requests_baseurl")
 
-    def load_yaml(path):
+def indent_lines(parts):
+    return "\n".join(
+        "  " + line if line.strip() else line
+        for part in parts
+        for line in part.splitlines() or [""]
+    )
+
+
+# Parsed YAML documents by content digest, and the last seen digest of every file.
+_yaml_documents = {}
+_yaml_digests = {}
+
+
+def load_yaml(path):
+    """Return the content digest and the documents of a YAML file.
+
+    Files are only read again when their mtime or size changed, and only parsed
+    again when their content changed.
+    """
+    yaml, loader = get_yaml()
+
+    path = Path(str(path)).resolve()
+    stat = path.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _yaml_digests.get(path)
+
+    if cached is not None and cached[0] == stamp:
+        digest = cached[1]
+        return digest, _yaml_documents[digest]
+
+    content = path.read_bytes()
+    digest = hashlib.blake2b(content).digest()
+
+    if digest not in _yaml_documents:
         try:
-            return list(yaml.safe_load_all(path.open()))
+            _yaml_documents[digest] = list(yaml.load_all(content, Loader=loader))
         except yaml.YAMLError as error:
-            raise InvalidSchema("YAMLError:\n{}".format(error)) from error
+            raise InvalidSchema("YAMLError in {}:\n{}".format(path, error)) from error
 
-    raw = load_yaml(fspath)
+    _yaml_digests[path] = (stamp, digest)
 
+    return digest, _yaml_documents[digest]
+
+
+def freeze_context(context: dict):
+    """Return a hashable key for the context, or None if it can't be hashed."""
     try:
-        specs = RestDocumentsType.transform(raw, context=context)
+        # 1, 1.0 and True are equal keys, but not the same in a template
+        context_key = tuple(
+            sorted((key, type(value), value) for key, value in context.items())
+        )
+        hash(context_key)
+    except TypeError:
+        return None
+
+    return context_key
+
+
+@lru_cache(maxsize=256)
+def _transform_spec(raw_hash, context_key):
+    return get_schemas().rest_documents.transform(
+        _yaml_documents[raw_hash],
+        context={key: value for key, _, value in context_key},
+    )
+
+
+def transform_include(raw_inc_stages, context):
+    assert len(raw_inc_stages) != 0, "Include files requires just one defined document"
+
+    return get_schemas().request_tests.transform(
+        value=raw_inc_stages[-1], context=context
+    )
+
+
+# Transformed include stages by (path, mtime, context)
+_include_cache = {}
+
+
+def load_include(incpath: Path, context: dict, context_key):
+    if context_key is None:
+        _, raw_inc_stages = load_yaml(incpath)
+        return transform_include(raw_inc_stages, context)
+
+    key = (str(incpath), incpath.stat().st_mtime_ns, context_key)
+
+    if key not in _include_cache:
+        _, raw_inc_stages = load_yaml(incpath)
+        _include_cache[key] = transform_include(raw_inc_stages, context)
+
+    return _include_cache[key]
+
+
+PluginOptions = namedtuple(
+    "PluginOptions", ["baseurl", "timeout", "extra_vars", "http2"]
+)
+
+
+def get_plugin_options(config) -> PluginOptions:
+    return PluginOptions(
+        baseurl=config.getoption("requests_baseurl"),
+        timeout=config.getoption("requests_timeout"),
+        extra_vars=config.getoption("extra_vars"),
+        http2=config.getoption("requests_http2"),
+    )
+
+
+def get_request_items(
+    fspath, parent=None, context: dict = None, plugin_options: PluginOptions = None
+):
+    import trafaret as t
+
+    context = {} if context is None else context
+
+    if parent is not None:
+        if plugin_options is None:
+            plugin_options = get_plugin_options(parent.config)
+
+        context["baseurl"] = plugin_options.baseurl
+
+    context_key = freeze_context(context)
+
+    raw_hash, raw = load_yaml(fspath)
+
+    try:
+        if context_key is None:
+            specs = get_schemas().rest_documents.transform(raw, context=context)
+        else:
+            specs = _transform_spec(raw_hash, context_key)
     except t.DataError as error:
         raise InvalidSchema(errors=error.as_dict(value=True)) from error
 
-    def run_stage(stage, session):
+    def run_stage(stage, session, session_variables):
         for options in stage["request"]:
-            name = "{spec[name]} - {options[method]} {options[url]}".format(
-                spec=spec, options=options
-            )
+            name = prefix + options["method"] + " " + options["url"]
 
-            yield RequestItem(
-                name,
-                parent=parent,
+            yield RequestItem.from_parent(
+                parent,
+                name=name,
                 spec=spec,
                 stage=stage,
                 request_options=options,
-                session=session,
+                requests_session=session,
+                session_variables=session_variables,
+                plugin_options=plugin_options,
             )
 
+    # Load every included file once, the paths are relative to the file
+    includes = {}
+
     for spec in specs:
-        with requests.Session() as spec_session:
-            for spec_stage in spec["stages"]:
-                if "include" in spec_stage:
-                    # Process include directive
-                    incpath = Path(spec_stage["include"])
+        for spec_stage in spec["stages"]:
+            if "include" in spec_stage and spec_stage["include"] not in includes:
+                incpath = (Path(fspath.dirname) / spec_stage["include"]).resolve()
+                includes[spec_stage["include"]] = load_include(
+                    incpath, context, context_key
+                )
+
+    for spec in specs:
+        prefix = spec["name"] + " - "
 
-                    # Temporary change the CWD to make the include path work relative to the file
-                    cwd = os.getcwd()
-                    os.chdir(fspath.dirname)
+        # Every spec uses its own cookies and variables, connections are pooled
+        spec_session = get_session(
+            http2=plugin_options is not None and plugin_options.http2
+        )
+        spec_variables = {}
+
+        for spec_stage in spec["stages"]:
+            if "include" in spec_stage:
+                for include_stage in includes[spec_stage["include"]]:
+                    yield from run_stage(include_stage, spec_session, spec_variables)
 
-                    raw_inc_stages = load_yaml(incpath)
+            else:
+                yield from run_stage(spec_stage, spec_session, spec_variables)
 
-                    os.chdir(cwd)  # Restore CWD
 
-                    assert (
-                        len(raw_inc_stages) != 0
-                    ), "Include files requires just one defined document"
+def get_item_waves(items):
+    """Group the items in waves that can run concurrently.
 
-                    raw_inc_stages = raw_inc_stages.pop()
+    An item runs after the items registering a variable it uses, and a variable
+    is only registered again after the items using the previous value.
+    """
+    waves = []
+    specs = {}
 
-                    included_stages = t.List(RequestTestType).transform(
-                        value=raw_inc_stages, context=context
-                    )
+    for item in items:
+        # Items of different specs don't share variables
+        registered, used = specs.setdefault(id(item.session_variables), ({}, {}))
 
-                    for include_stage in included_stages:
-                        yield from run_stage(include_stage, spec_session)
+        reads = item.get_used_variables()
+        writes = set(item.stage["register"])
 
-                else:
-                    yield from run_stage(spec_stage, spec_session)
+        wave = max(
+            [registered[name] + 1 for name in (reads | writes) if name in registered]
+            + [used[name] + 1 for name in writes if name in used],
+            default=0,
+        )
+
+        for name in reads:
+            used[name] = max(used.get(name, wave), wave)
+        for name in writes:
+            registered[name] = wave
+
+        if wave == len(waves):
+            waves.append([])
+
+        waves[wave].append(item)
+
+    return waves
 
 
 @pytest.fixture
 def request_items_runner(request):
+    def run_item(fspath, item):
+        __tracebackhide__ = True
+
+        try:
+            item.runtest()
+        except Exception as err:
+            msg = "File: {}\nFail: {.name}{}".format(fspath, item, err)
+            raise Failed(msg=msg, pytrace=False)
+
     def runner(fspath, context: dict = None):
         __tracebackhide__ = True
 
         fspath = request.fspath.dirpath(fspath)
+        items = get_request_items(fspath, parent=request.node, context=context)
 
-        for item in get_request_items(fspath, parent=request.node, context=context):
-            try:
-                item.runtest()
-            except Exception as err:
-                msg = "File: {}\nFail: {.name}{}".format(fspath, item, err)
-                raise Failed(msg=msg, pytrace=False)
+        if not request.config.getoption("requests_parallel"):
+            for item in items:
+                run_item(fspath, item)
+            return
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for wave in get_item_waves(items):
+                futures = [executor.submit(run_item, fspath, item) for item in wave]
+
+                # Report the first failure in the order of the stages
+                for future in futures:
+                    future.result()
 
     return runner
 
@@ -254,18 +682,31 @@ class FailRequestError(Exception):
         return "Error: {self.message!r}\nRequest args: {self.spec!r}".format(self=self)
 
 
-class MissingVariableError(AssertionError):
+class ResponseErrorMixin:
+    _formatted_response = None
+
+    @property
+    def formatted_response(self):
+        # Formatting large responses is slow, only do it when the error is shown
+        if self._formatted_response is None:
+            if self.response is None:
+                self._formatted_response = ""
+            else:
+                self._formatted_response = format_response(self.response)
+
+        return self._formatted_response
+
+
+class MissingVariableError(ResponseErrorMixin, AssertionError):
     def __init__(self, message, response):
         self.message = message
         self.response = response
 
     def __str__(self):
-        response = format_response(self.response) if self.response else ""
-
-        return "\n\n".join(["", response, self.message])
+        return "\n\n".join(["", self.formatted_response, self.message])
 
 
-class RequesAssertionError(AssertionError):
+class RequesAssertionError(ResponseErrorMixin, AssertionError):
     def __init__(self, expression, response):
         self.expression = expression
         self.response = response
@@ -274,48 +715,123 @@ class RequesAssertionError(AssertionError):
         return "\n\n".join(
             [
                 "",
-                format_response(self.response),
+                self.formatted_response,
                 "Stage expression failed %r" % self.expression,
             ]
         )
 
 
 class RequestItem(pytest.Item):
-    def __init__(self, name, parent, spec, stage, request_options, session):
+    def __init__(
+        self,
+        name,
+        parent,
+        spec,
+        stage,
+        request_options,
+        requests_session,
+        session_variables,
+        plugin_options=None,
+    ):
         super().__init__(name, parent)
         self.spec = spec
         self.stage = stage
-        self.requests_session = session
+        self.requests_session = requests_session
+        self.session_variables = session_variables
         self.request_options = request_options
 
-        extra_vars = self.config.getoption("extra_vars")
+        if plugin_options is None:
+            plugin_options = get_plugin_options(self.config)
 
-        self.config.hook.pytest_before_load_extra_vars(item=self, extra_vars=extra_vars)
+        self.plugin_options = plugin_options
+        self._extra_vars = None
+        self._baseurl = None
+        self._modname = _slugify(name)
 
-        self.extra_vars = extra_vars
+        # Compile the stage expressions once, errors are reported by runtest.
+        try:
+            for expression in self.stage["assert"]:
+                self.compile_assert(expression)
+            for value in self.stage["register"].values():
+                self.compile_register(value)
+        except (SyntaxError, TypeError, ValueError):
+            pass
+
+    @property
+    def extra_vars(self):
+        # Extra variables are loaded on first use, to keep the collection fast
+        if self._extra_vars is None:
+            extra_vars = self.plugin_options.extra_vars
+
+            self.config.hook.pytest_before_load_extra_vars(
+                item=self, extra_vars=extra_vars
+            )
 
-        baseurl = self.config.getoption("requests_baseurl")
+            self._extra_vars = extra_vars
 
-        # Prefer the baseurl defined in the options,
-        # then extra vars and finally default to localhost:8000
-        if baseurl:
-            self.baseurl = baseurl
-        elif "baseurl" in self.extra_vars:
-            self.baseurl = self.extra_vars["baseurl"]
-        else:
-            self.baseurl = "http://localhost:8000"
+        return self._extra_vars
 
-        self.timeout = self.config.getoption("requests_timeout")
+    @property
+    def baseurl(self):
+        if self._baseurl is None:
+            baseurl = self.plugin_options.baseurl
 
-    def get_response(self, options, variables):
-        def transform_strings(value):
-            if isinstance(value, str):
-                value = value.format(**variables)
-            return value
+            # Prefer the baseurl defined in the options,
+            # then extra vars and finally default to localhost:8000
+            if baseurl:
+                self._baseurl = baseurl
+            elif "baseurl" in self.extra_vars:
+                self._baseurl = self.extra_vars["baseurl"]
+            else:
+                self._baseurl = "http://localhost:8000"
+
+        return self._baseurl
+
+    @property
+    def timeout(self):
+        return self.plugin_options.timeout
+
+    def compile_assert(self, expression):
+        defname = "test_{modname}_stage".format(modname=self._modname)
+
+        return defname, _assert_code(defname, str(expression))
+
+    def compile_register(self, value):
+        return _compile_eval(value, self.parent.name if self.parent else "__main__")
 
+    def get_used_variables(self):
+        """Names of the variables the request, asserts or register could use."""
+        names = set()
+        stack = [self.request_options]
+
+        while stack:
+            value = stack.pop()
+
+            if isinstance(value, dict):
+                stack.extend(value.values())
+            elif isinstance(value, list):
+                stack.extend(value)
+            elif isinstance(value, str) and "{" in value:
+                try:
+                    fields = [field for _, field, _, _ in _formatter.parse(value)]
+                except ValueError:
+                    continue
+
+                # Positional or JSON-ish fields like {0} or {1: 2} name nothing
+                identifiers = (_identifiers(field) for field in fields if field)
+                names.update(ids[0] for ids in identifiers if ids)
+
+        for expression in self.stage["assert"]:
+            names.update(_identifiers(str(expression)))
+        for value in self.stage["register"].values():
+            names.update(_identifiers(str(value)))
+
+        return names
+
+    def get_response(self, options, variables):
         # Replace strings templates if posible
         try:
-            options = _.deep_map_values(options, transform_strings)
+            options = format_options(options, variables)
         except KeyError as error:
             raise MissingVariableError(
                 "Unknown variable {error}\n"
@@ -336,19 +852,15 @@ class RequestItem(pytest.Item):
     def run_assert_expression(self, expression, response, variables):
         __tracebackhide__ = True
 
-        modname = _.slugify(self.name).replace("-", "_")
-        defname = "test_{modname}_stage".format(modname=modname)
-
-        src = assert_def_source(defname=defname, expression=expression)
+        defname, code = self.compile_assert(expression)
 
-        namespace = ModuleType(modname)
-        namespace.__dict__.update({**variables})
+        namespace = {"__builtins__": __builtins__}
+        namespace.update(variables)
 
-        code = compile(src, modname, "exec")
-        exec(code, namespace.__dict__)
+        exec(code, namespace)
 
         try:
-            getattr(namespace, defname)()
+            namespace[defname]()
         except IndexError as error:
             raise MissingVariableError(
                 "Unknown item {error}\n"
@@ -364,6 +876,11 @@ class RequestItem(pytest.Item):
                 "{variables!r}".format(error=error, variables=variables),
                 variables["response"],
             )
+        except get_stream_errors() as error:
+            # Reading the streamed body failed, it's not the expression failing
+            raise FailRequestError(
+                spec=self.request_options, message=str(error)
+            ) from error
         except:
             raise RequesAssertionError(expression, response)
 
@@ -377,8 +894,7 @@ class RequestItem(pytest.Item):
         variables.update(self.spec["variables"])
 
         # Session variables are always the prefered variables
-        session_variables = getattr(self.requests_session, "variables", {})
-        variables.update(session_variables)
+        variables.update(self.session_variables)
 
         variables["baseurl"] = self.baseurl
         variables["response"] = None
@@ -388,16 +904,50 @@ class RequestItem(pytest.Item):
 
         variables["response"] = response
 
+        try:
+            self.run_stage_expressions(response, variables)
+        except BaseException as error:
+            # Nothing was registered, render the report while the body can still
+            # be read and give the connection back to the pool
+            if isinstance(error, ResponseErrorMixin):
+                error.formatted_response
+            response.close()
+            raise
+
+        # Only share the registered variables, the rest is loaded on every run
+        for key in self.stage["register"]:
+            self.session_variables[key] = variables[key]
+
+        # Only the values registered by this stage can be the response, other
+        # items of the spec may be updating the dict in parallel
+        registered = (self.session_variables[key] for key in self.stage["register"])
+
+        if not any(value is response for value in registered):
+            try:
+                release_response(response)
+            except get_stream_errors() as error:
+                raise FailRequestError(
+                    spec=self.request_options, message=str(error)
+                ) from error
+
+    def run_stage_expressions(self, response, variables):
+        __tracebackhide__ = True
+
         for expression in self.stage["assert"]:
             self.run_assert_expression(expression, response, variables)
 
+        namespace = {"__builtins__": __builtins__}
+        namespace.update(variables)
+
         for key, value in self.stage["register"].items():
-            code = compile(
-                value, self.parent.name if self.parent else "__main__", "eval"
-            )
+            code = self.compile_register(value)
 
             try:
-                variables[key] = eval(code, {**variables})
+                variables[key] = namespace[key] = eval(code, namespace)
+            except get_stream_errors() as error:
+                raise FailRequestError(
+                    spec=self.request_options, message=str(error)
+                ) from error
             except IndexError as error:
                 raise MissingVariableError(
                     "{code} {error}\n"
@@ -413,8 +963,6 @@ class RequestItem(pytest.Item):
                     variables["response"],
                 )
 
-        setattr(self.requests_session, "variables", variables)
-
     def reportinfo(self):
         name = transform_string_replace(self.name, self.extra_vars)
         return self.fspath, None, "stage: %s" % name
@@ -432,7 +980,9 @@ class RequestItem(pytest.Item):
 
 class RequestFile(pytest.File):
     def collect(self):
-        yield from get_request_items(self.fspath, self)
+        plugin_options = get_plugin_options(self.config)
+
+        yield from get_request_items(self.fspath, self, plugin_options=plugin_options)
 
     def repr_failure(self, excinfo):
         if isinstance(excinfo.value, InvalidSchema):
@@ -463,6 +1013,8 @@ class ExtraVariablesAction(argparse.Action):
         items = getattr(namespace, self.dest)
 
         if value.startswith("@"):
+            yaml, loader = get_yaml()
+
             # Load variables from file
             extravars_path = Path(value[1:])
 
@@ -472,7 +1024,7 @@ class ExtraVariablesAction(argparse.Action):
                 )
 
             try:
-                variables = yaml.safe_load(extravars_path.read_text())
+                variables = yaml.load(extravars_path.read_text(), Loader=loader)
             except yaml.YAMLError as err:
                 raise argparse.ArgumentError(self, "Unable to load variables: %r" % err)
 
@@ -508,12 +1060,19 @@ def pytest_addhooks(pluginmanager):
     pluginmanager.add_hookspecs(RequestHook())
 
 
+def pytest_unconfigure(config):
+    # Close the connections kept alive by the shared HTTP/2 transport
+    if get_httpx_transport.cache_info().currsize:
+        get_httpx_transport().close()
+        get_httpx_transport.cache_clear()
+
+
 def pytest_collect_file(parent, path):
     """Collect all request files"""
     if (path.fnmatch("*.yml") or path.fnmatch("*.yaml")) and path.basename.startswith(
         "test"
     ):
-        return RequestFile(path, parent)
+        return RequestFile.from_parent(parent, fspath=path)
 
 
 def pytest_addoption(parser):
@@ -540,3 +1099,17 @@ def pytest_addoption(parser):
         action=ExtraVariablesAction,
         help="set additional variables as key=value or by loading a file @path/to/variables.yml",
     )
+
+    group.addoption(
+        "--requests-http2",
+        action="store_true",
+        default=False,
+        help="Make the requests with HTTP/2, requires httpx[http2] installed.",
+    )
+
+    group.addoption(
+        "--requests-parallel",
+        action="store_true",
+        default=False,
+        help="Run independent stages concurrently in request_items_runner.",
+    )
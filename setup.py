@@ -22,7 +22,8 @@ setup(
     long_description=read("README.rst"),
     py_modules=["pytest_python_requests"],
     python_requires=">=3.6",
-    install_requires=["pytest>=3.5.0", "pyyaml", "pydash", "trafaret>=2.0.0", "requests"],
+    install_requires=["pytest>=5.4.0", "pyyaml", "trafaret>=2.0.0", "requests"],
+    extras_require={"http2": ["httpx[http2]"]},
     classifiers=[
         "Development Status :: 4 - Beta",
         "Framework :: Pytest",
@@ -1,3 +1,30 @@
+import importlib
+import io
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from pytest_python_requests import (
+    HTTPXResponse,
+    HTTPXSession,
+    RequestItem,
+    format_response,
+    get_pooled_adapter,
+    get_request_items,
+    get_item_waves,
+    get_session,
+    _transform_spec,
+    load_yaml,
+    session_request,
+    transform_include,
+)
+
+
 def test_request_items_runner_fixture(testdir):
     """Make sure that pytest accepts our fixture."""
 
@@ -26,3 +53,441 @@ def test_help_message(testdir):
     result.stdout.fnmatch_lines(["requests:", "*--requests-baseurl*"])
     result.stdout.fnmatch_lines(["requests:", "*--requests-timeout*"])
     result.stdout.fnmatch_lines(["requests:", "*--requests-extra-vars*"])
+    result.stdout.fnmatch_lines(["requests:", "*--requests-http2*"])
+    result.stdout.fnmatch_lines(["requests:", "*--requests-parallel*"])
+
+
+@pytest.fixture
+def truncated_server():
+    """Serve responses announcing 100 bytes of body but sending only 10."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+
+            with conn:
+                conn.recv(65536)
+                conn.sendall(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"Content-Length: 100\r\n\r\n"
+                    b'{"a": 1, "'
+                )
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    yield "http://127.0.0.1:%s" % server.getsockname()[1]
+
+    server.close()
+
+
+def test_truncated_body_fails_the_request(testdir, truncated_server):
+    testdir.makefile(
+        ".yml",
+        test_truncated="""
+        name: Truncated
+        stages:
+          - request: /json
+            assert:
+              - response.json()["a"] == 1
+          - request: /status
+            assert:
+              - response.status_code == 200
+        """,
+    )
+
+    result = testdir.runpytest("-v", "--requests-baseurl", truncated_server)
+
+    result.stdout.fnmatch_lines(["*IncompleteRead*", "*IncompleteRead*"])
+    result.stdout.no_fnmatch_line("*INTERNALERROR*")
+    result.assert_outcomes(failed=2)
+
+
+class PlainTextHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        status = 500 if self.path == "/error" else 200
+        body = b"Not JSON " * (100000 if self.path == "/big" else 1)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def text_server():
+    """Serve plain text bodies, a 500 status for /error and 900 KB for /big."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PlainTextHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield "http://127.0.0.1:%s" % server.server_address[1]
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_body_errors_fail_the_assertion(testdir, text_server):
+    testdir.makefile(
+        ".yml",
+        test_text="""
+        name: Text
+        stages:
+          - request: /text
+            assert:
+              - response.json()["a"] == 1
+          - request: /error
+            assert:
+              - response.raise_for_status() is None
+        """,
+    )
+
+    result = testdir.runpytest("-v", "--requests-baseurl", text_server)
+
+    result.stdout.fnmatch_lines(
+        [
+            "*HTTP/1.1 200*",
+            "*Not JSON*",
+            "*Stage expression failed 'response.json()[[]\"a\"[]] == 1'*",
+            "*HTTP/1.1 500*",
+            "*Not JSON*",
+            "*Stage expression failed 'response.raise_for_status() is None'*",
+        ]
+    )
+    result.stdout.no_fnmatch_line("*Request args*")
+    result.assert_outcomes(failed=2)
+
+
+def test_failed_stages_release_the_connection(testdir, text_server):
+    testdir.makefile(
+        ".yml",
+        test_big="""
+        name: Big
+        stages:
+          - request: /big
+            assert:
+              - response.status_code == 201
+          - request: /big
+            register:
+              missing: response.missing
+        """,
+    )
+
+    result = testdir.runpytest("-v", "--requests-baseurl", text_server)
+
+    # The reports are rendered before the responses are closed
+    result.stdout.fnmatch_lines(["*Not JSON*", "*(truncated)*"] * 2)
+    result.assert_outcomes(failed=2)
+
+    pools = get_pooled_adapter().poolmanager.pools
+    port = urlsplit(text_server).port
+    pool = next(pools[key] for key in pools.keys() if key.key_port == port)
+
+    assert pool.pool.qsize() == pool.pool.maxsize
+
+
+def test_yaml_error_names_the_included_file(testdir):
+    testdir.makefile(
+        ".yml",
+        test_login="""
+        name: Login
+        stages:
+          - include: broken.yml
+        """,
+        broken="""
+        name: [Broken
+        """,
+    )
+
+    result = testdir.runpytest("-v")
+
+    result.stdout.fnmatch_lines(["*YAMLError in *broken.yml:*"])
+
+
+def test_load_yaml_after_yaml_is_imported_again(tmp_path, monkeypatch):
+    (tmp_path / "first.yml").write_text("name: First\n")
+    load_yaml(tmp_path / "first.yml")
+
+    # Like pytester restoring sys.modules after an inline run
+    for name in [name for name in sys.modules if name.split(".")[0] == "yaml"]:
+        monkeypatch.delitem(sys.modules, name)
+    importlib.import_module("yaml")
+
+    (tmp_path / "second.yml").write_text("name: Second\n")
+
+    assert load_yaml(tmp_path / "second.yml")[1] == [{"name": "Second"}]
+
+
+def collect_urls(request, path, context=None):
+    items = get_request_items(path, request.node, context=context)
+    return [item.request_options["url"] for item in items]
+
+
+def test_context_values_of_other_types_are_not_shared(request, tmpdir):
+    path = tmpdir.join("test_flag.yml")
+    path.write("name: Flag\nstages:\n  - request: /x/{flag}\n")
+
+    assert collect_urls(request, path, {"flag": 1}) == ["/x/1"]
+    assert collect_urls(request, path, {"flag": True}) == ["/x/True"]
+    assert collect_urls(request, path, {"flag": 1.0}) == ["/x/1.0"]
+
+
+def test_edited_files_are_loaded_again(request, tmpdir):
+    path = tmpdir.join("test_edit.yml")
+    path.write("name: Edit\nstages:\n  - include: login.yml\n  - request: /a\n")
+    include = tmpdir.join("login.yml")
+    include.write("- request: /login\n")
+
+    assert collect_urls(request, path) == ["/login", "/a"]
+
+    # Same sizes, only the mtimes tell the files changed
+    path.write("name: Edit\nstages:\n  - include: login.yml\n  - request: /b\n")
+    include.write("- request: /logon\n")
+
+    for edited in (path, include):
+        edited.setmtime(edited.mtime() + 1)
+
+    assert collect_urls(request, path) == ["/logon", "/b"]
+
+
+def test_every_context_gets_its_own_transform(request, tmpdir):
+    path = tmpdir.join("test_who.yml")
+    path.write("name: Who\nstages:\n  - request: /me/{who}\n")
+
+    before = _transform_spec.cache_info()
+
+    assert collect_urls(request, path, {"who": "fred"}) == ["/me/fred"]
+    assert collect_urls(request, path, {"who": "wilma"}) == ["/me/wilma"]
+    assert collect_urls(request, path, {"who": "fred"}) == ["/me/fred"]
+
+    after = _transform_spec.cache_info()
+
+    assert after.misses - before.misses == 2
+    assert after.hits - before.hits == 1
+
+
+def test_shared_include_is_transformed_once(request, tmpdir, monkeypatch):
+    calls = []
+
+    def counting_transform_include(raw_inc_stages, context):
+        calls.append(raw_inc_stages)
+        return transform_include(raw_inc_stages, context)
+
+    monkeypatch.setattr(
+        "pytest_python_requests.transform_include", counting_transform_include
+    )
+
+    path = tmpdir.join("test_shared.yml")
+    path.write(
+        "name: First\nstages:\n  - include: login.yml\n  - request: /first\n"
+        "---\n"
+        "name: Second\nstages:\n  - include: login.yml\n  - request: /second\n"
+    )
+    tmpdir.join("login.yml").write("- request: /login\n")
+
+    urls = ["/login", "/first", "/login", "/second"]
+
+    assert collect_urls(request, path) == urls
+    assert collect_urls(request, path) == urls
+    assert len(calls) == 1
+
+    # An unhashable context isn't cached, the include is still loaded once a file
+    assert collect_urls(request, path, {"ids": [1, 2]}) == urls
+    assert len(calls) == 2
+
+
+class StubItem:
+    """Just what get_item_waves needs from a RequestItem."""
+
+    get_used_variables = RequestItem.get_used_variables
+
+    def __init__(self, name, session_variables, url="/", asserts=(), register=None):
+        self.name = name
+        self.session_variables = session_variables
+        self.request_options = {"method": "GET", "url": url}
+        self.stage = {"assert": list(asserts), "register": register or {}}
+
+
+def test_used_variables_ignores_positional_fields():
+    item = StubItem("item", {}, url="/{who.name}/{0}/{1: 2}/{}", asserts=["ok"])
+
+    assert item.get_used_variables() == {"who", "ok"}
+
+
+def test_item_waves():
+    spec, other_spec = {}, {}
+
+    login = StubItem("login", spec, register={"token": "response.json()['t']"})
+    profile = StubItem("profile", spec, url="/me/{token}")
+    independent = StubItem("independent", spec, url="/ping")
+    relogin = StubItem("relogin", spec, register={"token": "'other'"})
+    check = StubItem("check", spec, asserts=["token == 'other'"])
+    other = StubItem("other", other_spec, url="/me/{token}")
+
+    waves = get_item_waves([login, profile, independent, relogin, check, other])
+
+    assert [[item.name for item in wave] for wave in waves] == [
+        # Other specs never wait for this spec
+        ["login", "independent", "other"],
+        # Uses the token registered by login
+        ["profile"],
+        # Registers token again, after profile used the first one
+        ["relogin"],
+        ["check"],
+    ]
+
+
+class StubSession:
+    def request(self, **options):
+        self.options = options
+
+
+@pytest.mark.parametrize(
+    "method, allow_redirects",
+    [("GET", True), ("OPTIONS", True), ("HEAD", False), ("POST", True)],
+)
+def test_allow_redirects_by_method(method, allow_redirects):
+    session = StubSession()
+
+    session_request(session, method=method, url="http://example.com/")
+
+    assert session.options["allow_redirects"] is allow_redirects
+
+
+def test_allow_redirects_is_not_overridden():
+    session = StubSession()
+
+    session_request(
+        session, method="HEAD", url="http://example.com/", allow_redirects=True
+    )
+
+    assert session.options["allow_redirects"] is True
+
+
+def make_response(content_type, body):
+    response = requests.Response()
+    response.request = requests.Request("GET", "http://example.com/").prepare()
+    response.status_code = 200
+    response.headers["Content-Type"] = content_type
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.raw = io.BytesIO(body)
+    return response
+
+
+@pytest.mark.parametrize(
+    "content_type, encoding",
+    [
+        ("text/plain", "utf-8"),
+        ("application/json", "utf-8"),
+        ("text/plain; charset=utf-16", "utf-16"),
+        ('text/plain; charset="latin-1"', "latin-1"),
+    ],
+)
+def test_format_response_decodes_the_body(content_type, encoding):
+    response = make_response(content_type, "Año".encode(encoding))
+
+    assert format_response(response).endswith("\n  Año")
+
+
+def test_http2_falls_back_to_requests(monkeypatch):
+    monkeypatch.setitem(sys.modules, "httpx", None)
+
+    with pytest.warns(UserWarning, match="httpx"):
+        session = get_session(http2=True)
+
+    assert isinstance(session, requests.Session)
+
+
+class StubHTTPXRequest:
+    method = "POST"
+    url = "http://example.com/login"
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    def read(self):
+        return b"user=admin"
+
+
+class StubURL:
+    def __str__(self):
+        return "http://example.com/login"
+
+
+class StubHTTPXResponse:
+    request = StubHTTPXRequest()
+    url = StubURL()
+    status_code = 201
+    reason_phrase = "Created"
+    headers = {"Content-Type": "application/json"}
+    is_success = True
+
+    def iter_bytes(self, chunk_size):
+        yield b'{"token":'
+        yield b' "abc"}'
+
+    def json(self):
+        return {"token": "abc"}
+
+
+def test_httpx_response_wrapper():
+    response = HTTPXResponse(StubHTTPXResponse())
+
+    assert response.request.method == "POST"
+    assert response.request.url == "http://example.com/login"
+    assert response.request.body == b"user=admin"
+    assert response.ok
+    assert response.url == "http://example.com/login"
+    assert response.reason == "Created"
+    assert response.status_code == 201
+    assert response.json() == {"token": "abc"}
+    assert b"".join(response.iter_content(1024)) == b'{"token": "abc"}'
+
+    formatted = format_response(response)
+    assert "POST http://example.com/login" in formatted
+    assert "user=admin" in formatted
+    assert '{"token": "abc"}' in formatted
+
+
+def test_httpx_session_request():
+    httpx = pytest.importorskip("httpx")
+
+    def handler(request):
+        if request.url.path == "/redirect":
+            return httpx.Response(302, headers={"Location": "/final"})
+        return httpx.Response(200, text=request.url.path)
+
+    session = HTTPXSession(httpx.MockTransport(handler))
+
+    response = session.request("GET", "http://example.com/redirect")
+    assert response.ok
+    assert response.url == "http://example.com/final"
+    assert response.reason == "OK"
+    assert response.text == "/final"
+
+    response = session.request(
+        "GET", "http://example.com/redirect", allow_redirects=False
+    )
+    assert response.status_code == 302
+    assert response.request.body is None
+
+
+def test_httpx_session_errors_are_request_exceptions():
+    httpx = pytest.importorskip("httpx")
+
+    def handler(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    session = HTTPXSession(httpx.MockTransport(handler))
+
+    with pytest.raises(requests.RequestException, match="connection refused"):
+        session.request("GET", "http://example.com/")